@@ -1,17 +1,66 @@
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
+from typing import Final, TypedDict
+import httpx
 import streamlit as st
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from langchain.chat_models import init_chat_model
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
 from langgraph.graph import StateGraph, MessagesState, START, END
+from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import create_react_agent
-from langgraph_supervisor import create_supervisor
-from langchain_tavily import TavilySearch
-from langchain_google_community import CalendarToolkit
-from langchain_google_community.calendar.utils import (
-    build_resource_service,
-    get_google_credentials,
+
+# The Tavily, Google and supervisor integrations are imported inside the functions that use
+# them: they are slow to import and only needed once, when the cached builders first run.
+
+logger = logging.getLogger(__name__)
+
+# Opening of the fenced block the work agents answer with. Compiled once at import time; it is
+# used on every turn by the formatter, the router after the work agents, and the reply cache.
+# Only the label is matched: the JSON object after it is read with a JSON decoder, so code
+# fences inside string values (common in search snippets) cannot end the block early.
+RESULT_JSON_FENCE = re.compile(r"```json\s+RESULT_JSON\s*")
+JSON_DECODER = json.JSONDecoder()
+
+# Model and prompts shared by the agent factories. They never change at runtime, so they are
+# defined once per process. The output contract is shared by both work agents; the formatter
+# and the router look for exactly this fence.
+
+MODEL_NAME: Final[str] = "openai:gpt-4o-mini"
+
+RESULT_JSON_CONTRACT: Final[str] = "Reply with exactly one block ```json RESULT_JSON\n{...}\n``` and nothing else."
+
+CALENDAR_PROMPT: Final[str] = (
+    "Calendar agent. Use the tools to create, search, update, move or delete events; "
+    "timezone is always 'Europe/Berlin'. If date or time is missing, reply with one short "
+    "clarifying question only.\n"
+    f"{RESULT_JSON_CONTRACT}\n"
+    'Schema: {"agent":"calendar","op":"create|update|delete|move|search|info|error",'
+    '"ok":bool,"data":<tool output>,"message":str,"timezone":"Europe/Berlin"}'
+)
+
+RESEARCH_PROMPT: Final[str] = (
+    "Research agent. Search the web with Tavily.\n"
+    f"{RESULT_JSON_CONTRACT}\n"
+    'Schema: {"agent":"research","op":"search","ok":bool,'
+    '"data":[{"title":str,"url":str,"snippet":str}],"message":str}. No hits: ok=false, data=[].'
+)
+
+SUPERVISOR_PROMPT: Final[str] = (
+    "Supervisor. Hand the request to exactly one agent: research_agent (web research) or "
+    "calendar_agent (Google Calendar). Never answer or reformat yourself; "
+    "end right after the agent returns."
 )
 
 
@@ -35,18 +84,89 @@ def bootstrap_secrets() -> None:
 
 
 
+# Loads the Google OAuth credentials once per process (from token.json, refreshed if expired).
+# A background thread refreshes them shortly before they expire, so no chat turn ever
+# waits for a token refresh. token.json is only rewritten when the token actually changed.
+
+TOKEN_FILE = "token.json"
+CALENDAR_SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+TOKEN_REFRESH_MARGIN = timedelta(seconds=300)
+TOKEN_CHECK_INTERVAL_SECONDS = 60
+
+
+@st.cache_resource(show_spinner=False)
+def get_calendar_credentials():
+    """Return the Google credentials (requires credentials.json and token.json)."""
+    from langchain_google_community.calendar.utils import get_google_credentials
+
+    return get_google_credentials(
+        token_file=TOKEN_FILE,
+        scopes=CALENDAR_SCOPES,
+        client_secrets_file="credentials.json",
+    )
+
+
+def refresh_credentials_if_expiring(credentials) -> None:
+    """Refresh `credentials` if they expire within TOKEN_REFRESH_MARGIN and persist the new token."""
+    # google-auth keeps `expiry` as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if credentials.expiry is None or credentials.expiry - now > TOKEN_REFRESH_MARGIN:
+        return
+    from google.auth.transport.requests import Request
+
+    previous_token = credentials.token
+    credentials.refresh(Request())
+    if credentials.token != previous_token:
+        Path(TOKEN_FILE).write_text(credentials.to_json())
+
+
+@st.cache_resource(show_spinner=False)
+def start_token_refresher() -> threading.Thread:
+    """Start the daemon thread that keeps the Google token fresh (once per process)."""
+    credentials = get_calendar_credentials()
+
+    def run():
+        while True:
+            try:
+                refresh_credentials_if_expiring(credentials)
+            except Exception:
+                logger.warning("Google token refresh failed; retrying later.", exc_info=True)
+            time.sleep(TOKEN_CHECK_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=run, name="google-token-refresher", daemon=True)
+    thread.start()
+    return thread
+
+
+
 # Sets up Google Calendar tools for the agent (create, update, search events).
 # Uses CalendarToolkit to wrap the API instead of calling Google HTTP directly.
-# Needs credentials.json (from Google Console) and token.json (created after first login).
+# Cached per process; the discovery document is the static copy bundled with
+# google-api-python-client, so building the service does not fetch it over HTTPS.
+# httplib2 is not thread-safe, and parallel tool calls run in worker threads, so each thread
+# gets its own authorized connection (kept alive across its requests) instead of sharing one.
 
+@st.cache_resource(show_spinner=False)
 def build_calendar_tools():
     """Return CalendarToolkit tools (requires credentials.json and token.json)."""
-    credentials = get_google_credentials(
-        token_file="token.json",
-        scopes=["https://www.googleapis.com/auth/calendar.events"],
-        client_secrets_file="credentials.json",
+    import google_auth_httplib2
+    import httplib2
+    from googleapiclient.discovery import build as build_google_service
+    from googleapiclient.http import HttpRequest
+    from langchain_google_community import CalendarToolkit
+
+    credentials = get_calendar_credentials()
+    per_thread = threading.local()
+
+    def build_request(_http, *args, **kwargs):
+        http = getattr(per_thread, "http", None)
+        if http is None:
+            http = per_thread.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        return HttpRequest(http, *args, **kwargs)
+
+    api_resource = build_google_service(
+        "calendar", "v3", credentials=credentials, requestBuilder=build_request, static_discovery=True
     )
-    api_resource = build_resource_service(credentials=credentials)
     return CalendarToolkit(api_resource=api_resource).get_tools()
 
 
@@ -54,11 +174,31 @@ def build_calendar_tools():
 
 # Agents:
 
+# All agents share one chat model instance and one async HTTP connection pool, so the
+# supervisor and the work agents reuse the same keep-alive connections to the OpenAI API.
+
+@lru_cache(maxsize=1)
+def get_http_async_client() -> httpx.AsyncClient:
+    """Return the process-wide async HTTP client used for model calls."""
+    return httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=32))
+
+
+@lru_cache(maxsize=4)
+def get_model(name: str = MODEL_NAME):
+    """Return the shared chat model for `name`."""
+    return init_chat_model(name, http_async_client=get_http_async_client())
+
+
+
 # Function builds the calendar agent with its prompt and tools that uses the provided 
 # Google Calendar tools to create, update, search, or delete events. 
 # The output is always forced into a JSON block (RESULT_JSON) so it can be parsed later. 
 # Timezone is fixed to Europe/Berlin to keep results consistent.
+# The tools list comes from the cached build_calendar_tools, so it is hashed by identity.
+# OpenAI issues parallel tool calls by default, and under ainvoke the agent's ToolNode runs
+# them concurrently, so independent calendar operations from one model turn overlap.
 
+@st.cache_resource(show_spinner=False, hash_funcs={list: id})
 def create_calendar_agent(tools):
     """
     Calendar work agent: DOES work using tools and outputs ONLY a fenced JSON block:
@@ -68,27 +208,78 @@ def create_calendar_agent(tools):
       "ok":true|false,"data":<tool output>,"message":"...", "timezone":"Europe/Berlin" }
     ```
     """
-    prompt = (
-        "You are a Calendar work agent.\n\n"
-        "TASK:\n"
-        "- Use the provided tools to create, search, update, move, and delete events.\n"
-        "- ALWAYS set timezone to 'Europe/Berlin'.\n"
-        "- If date/time/calendar is missing, ask exactly one clarifying question via tool use if needed.\n\n"
-        "OUTPUT CONTRACT (very important):\n"
-        "- After completing the operation(s), respond ONLY with a single fenced JSON block labeled RESULT_JSON.\n"
-        "- No other text. JSON must match the schema in the docstring."
+    return create_react_agent(
+        model=get_model(MODEL_NAME),
+        tools=tools,
+        prompt=CALENDAR_PROMPT,
+        name="calendar_agent",
     )
-    model = init_chat_model("openai:gpt-4o-mini")
-    return create_react_agent(model=model, tools=tools, prompt=prompt, name="calendar_agent")
 
 
 
 
+# Function builds the web search tool for the research agent: TavilySearch with a shared
+# TTL cache keyed on the normalized query and search options. Identical queries issued
+# concurrently (e.g. parallel tool calls in one model turn) share a single request.
+# Only successful results are cached.
+
+TAVILY_CACHE = TTLCache(maxsize=256, ttl=600)
+TAVILY_CACHE_LOCK = threading.Lock()
+TAVILY_IN_FLIGHT = {}
+
+
+def tavily_cache_key(query: str, max_results: int, options: dict) -> bytes:
+    """Hash the normalized query together with everything else that changes the result."""
+    raw = json.dumps([query.lower().strip(), max_results, options], sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode()).digest()
+
+
+def create_web_search_tool(max_results: int = 5):
+    """Return a cached TavilySearch tool."""
+    from langchain_tavily import TavilySearch
+
+    class CachedTavily(TavilySearch):
+        def _lookup(self, key):
+            with TAVILY_CACHE_LOCK:
+                return TAVILY_CACHE.get(key)
+
+        def _store(self, key, result):
+            if isinstance(result, dict) and "error" not in result:
+                with TAVILY_CACHE_LOCK:
+                    TAVILY_CACHE[key] = result
+
+        def _run(self, query: str, run_manager=None, **kwargs):
+            key = tavily_cache_key(query, self.max_results, kwargs)
+            result = self._lookup(key)
+            if result is None:
+                result = super()._run(query, run_manager=run_manager, **kwargs)
+                self._store(key, result)
+            return result
+
+        async def _arun(self, query: str, run_manager=None, **kwargs):
+            key = tavily_cache_key(query, self.max_results, kwargs)
+            result = self._lookup(key)
+            if result is not None:
+                return result
+            pending = TAVILY_IN_FLIGHT.get(key)
+            if pending is None:
+                pending = asyncio.ensure_future(super()._arun(query, run_manager=run_manager, **kwargs))
+                TAVILY_IN_FLIGHT[key] = pending
+                pending.add_done_callback(lambda _: TAVILY_IN_FLIGHT.pop(key, None))
+            result = await asyncio.shield(pending)
+            self._store(key, result)
+            return result
+
+    return CachedTavily(max_results=max_results)
+
+
+
 # Function builds the research agent with its prompt and tools. 
 # It uses TavilySearch to perform web searches and gather information. 
 # The agent always outputs the results in a JSON block (RESULT_JSON) with a simple schema 
 # that includes title, url, and snippet for each search result.
 
+@st.cache_resource(show_spinner=False)
 def create_research_agent():
     """
     Research work agent: DOES research via Tavily and outputs ONLY a fenced JSON block:
@@ -98,56 +289,164 @@ def create_research_agent():
       "data":[{"title":"...","url":"...","snippet":"..."}], "message":"..." }
     ```
     """
-    prompt = (
-        "You are a Research work agent.\n\n"
-        "TASK:\n"
-        "- Perform only research-related tasks using Tavily.\n\n"
-        "OUTPUT CONTRACT (very important):\n"
-        "- Respond ONLY with a single fenced JSON block labeled RESULT_JSON. No other text.\n"
-        "- Normalize results to the schema in the docstring. If no hits, ok=false, data=[]."
+    return create_react_agent(
+        model=get_model(MODEL_NAME),
+        tools=[create_web_search_tool(max_results=5)],
+        prompt=RESEARCH_PROMPT,
+        name="research_agent",
     )
-    model = init_chat_model("openai:gpt-4o-mini")
-    web_search = TavilySearch(max_results=5)
-    return create_react_agent(model=model, tools=[web_search], prompt=prompt, name="research_agent")
 
 
 
 
-# Function builds the formatter agent. Agent does not call any tools. It follows specific rendering rules 
-# based on the content of RESULT_JSON.
-# The agent reads the most recent RESULT_JSON block from the conversation context, parses it, and
-# produces a clean, user-friendly Markdown summary of the results.
+# Formatter: plain Python, no LLM. It follows specific rendering rules based on the content
+# of RESULT_JSON. It reads the most recent RESULT_JSON block from the conversation, parses it,
+# and produces a clean, user-friendly Markdown summary of the results.
+# Turning JSON into Markdown is a pure string transformation, so a model round-trip is not needed.
+
+MUTATING_OPS = {"create", "update", "move", "delete"}
 
-def create_formatter_agent():
+
+def extract_last_result_json(msgs) -> dict | None:
+    """Return the most recent parsed RESULT_JSON dict in `msgs`, or None."""
+    for msg in reversed(msgs):
+        text = message_text(msg)
+        match = RESULT_JSON_FENCE.search(text)
+        if match:
+            try:
+                data, _ = JSON_DECODER.raw_decode(text, match.end())
+            except json.JSONDecodeError:
+                continue
+            if isinstance(data, dict):
+                return data
+    return None
+
+
+def has_result_json_label(msgs) -> bool:
+    """Return True if an AI message in `msgs` carries a RESULT_JSON fence, parsable or not."""
+    return any(
+        isinstance(msg, AIMessage) and RESULT_JSON_FENCE.search(message_text(msg)) for msg in msgs
+    )
+
+
+def _when(value) -> str:
+    """Calendar times come either as plain strings or as {"dateTime"|"date": ...} objects."""
+    if isinstance(value, dict):
+        return str(value.get("dateTime") or value.get("date") or "")
+    return str(value or "")
+
+
+def _attendees(value) -> str:
+    if not value:
+        return ""
+    if isinstance(value, list):
+        return ", ".join(a.get("email", "") if isinstance(a, dict) else str(a) for a in value)
+    return str(value)
+
+
+def _render_event(event: dict) -> str:
+    line = f"**{event.get('summary') or '(no title)'}** — {_when(event.get('start'))}"
+    end = _when(event.get("end"))
+    if end:
+        line += f" → {end}"
+    if event.get("location"):
+        line += f" · 📍 {event['location']}"
+    attendees = _attendees(event.get("attendees"))
+    if attendees:
+        line += f" · 👥 {attendees}"
+    return line
+
+
+def _render_table(rows: list) -> str:
+    columns = list(dict.fromkeys(k for row in rows for k in row))[:6]
+    lines = ["| " + " | ".join(columns) + " |", "|" + " --- |" * len(columns)]
+    for row in rows:
+        cells = (str(row.get(c, "")).replace("|", "\\|").replace("\n", " ") for c in columns)
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def _render_calendar(data: dict) -> str:
+    op, payload, message = data.get("op"), data.get("data"), data.get("message") or ""
+    if not isinstance(op, str):
+        op = ""
+    if not data.get("ok"):
+        return f"⚠️ {message}" if message else "No results."
+    if op == "search":
+        events = payload if isinstance(payload, list) else []
+        if not events:
+            return message or "No events found."
+        return "\n".join(f"- {_render_event(e)}" if isinstance(e, dict) else f"- {e}" for e in events)
+    if op in MUTATING_OPS:
+        verb = {"create": "created", "update": "updated", "move": "moved", "delete": "deleted"}[op]
+        if isinstance(payload, dict) and payload.get("summary"):
+            return f"✅ Event {verb}: {_render_event(payload)}"
+        return f"✅ Event {verb}." + (f" {message}" if message else "")
+    return message or str(payload or "")
+
+
+def _render_research(data: dict) -> str:
+    items = data.get("data") if isinstance(data.get("data"), list) else []
+    if not data.get("ok") or not items:
+        return "No high-quality sources found."
+    lines = []
+    for item in items[:5]:
+        if not isinstance(item, dict):
+            continue
+        title, url = item.get("title") or item.get("url") or "Source", item.get("url") or ""
+        link = f"[{title}]({url})" if url else title
+        snippet = item.get("snippet") or item.get("content") or ""
+        lines.append(f"- {link} — {snippet}" if snippet else f"- {link}")
+    return "\n".join(lines) or "No high-quality sources found."
+
+
+def format_result_json(messages) -> str:
     """
-    Formatter agent: DOES NOT call tools. It scans prior messages, finds the most recent
-    fenced JSON block labeled RESULT_JSON, parses it, and produces user-friendly Markdown.
+    Render the most recent RESULT_JSON block in `messages` as Markdown.
 
     - calendar/search: list events (summary, start, end, location, attendees)
     - calendar/create|update|move|delete: short confirmation with key fields
     - research/search: list up to 5 links: [Title](url) — snippet
     - fallback: if data is an array of objects, infer columns and show a simple table
     - If no RESULT_JSON present: explain that no tool output was found to format
+    - If RESULT_JSON is present but unparsable: say it could not be formatted
     """
-    prompt = (
-        "You are a Formatter agent.\n\n"
-        "TASK:\n"
-        "- Read the conversation so far, find the most recent fenced JSON block labeled RESULT_JSON,\n"
-        "  parse it, and produce a clean, user-friendly Markdown summary of the results.\n"
-        "- Do NOT call any tools.\n\n"
-        "RENDERING RULES:\n"
-        "- If RESULT_JSON.agent == 'calendar':\n"
-        "   * op=='search': bulleted list of events (summary, start, end, location, attendees).\n"
-        "   * op in ['create','update','move','delete']: concise confirmation with key fields.\n"
-        "   * if ok==false: concise error or 'no results'.\n"
-        "- If RESULT_JSON.agent == 'research':\n"
-        "   * ok==true: up to 5 items as: [Title](url) — snippet.\n"
-        "   * ok==false: 'no high-quality sources found'.\n"
-        "- Fallback: if data is an array of objects, infer up to 6 columns and render a simple table.\n"
-        "- Keep it concise. Use Markdown only. No JSON or code blocks in the final output."
-    )
-    model = init_chat_model("openai:gpt-4o-mini")
-    return create_react_agent(model=model, tools=[], prompt=prompt, name="formatter_agent")
+    data = extract_last_result_json(messages)
+    if data is None:
+        if has_result_json_label(messages):
+            return "⚠️ The tool output could not be formatted."
+        return "No tool output was found to format."
+    agent = data.get("agent")
+    if agent == "calendar":
+        return _render_calendar(data)
+    if agent == "research":
+        return _render_research(data)
+    payload = data.get("data")
+    if isinstance(payload, list) and payload and all(isinstance(row, dict) for row in payload):
+        return _render_table(payload)
+    return data.get("message") or str(payload or "")
+
+
+# Graph state: the message history plus the rendered reply. The reply has its own channel and
+# is the only output of the graph, so callers read it directly instead of receiving (and
+# walking) the whole message list.
+
+class AgentState(MessagesState):
+    final: str
+
+
+class ReplyState(TypedDict):
+    final: str
+
+
+def formatter_node(state: AgentState):
+    """Graph node: render the Markdown reply into the `final` channel."""
+    return {"final": format_result_json(state["messages"])}
+
+
+def passthrough_node(state: AgentState):
+    """Graph node: use the agent's own last message as the reply (nothing to format)."""
+    return {"final": last_reply_text(state["messages"])}
 
 
 
@@ -155,7 +454,10 @@ def create_formatter_agent():
 # The supervisor decides which work agent (research or calendar) should handle the user’s request. 
 # It always picks exactly one agent and does not add its own answer. 
 # The chosen agent then produces the RESULT_JSON, which will be formatted later.
+# Only the work agent's final message (the RESULT_JSON) is handed back, not its tool calls,
+# so neither the supervisor's second model call nor the parent state grows with tool traffic.
 
+@st.cache_resource(show_spinner=False, hash_funcs={CompiledStateGraph: id})
 def create_supervisor_runnable(research_agent, calendar_agent):
     """
     Supervisor policy:
@@ -163,62 +465,214 @@ def create_supervisor_runnable(research_agent, calendar_agent):
     - After the chosen agent returns, STOP. Do not add your own user-facing message.
     - The work agent must output a RESULT_JSON block which the next node will format.
     """
-    sup_prompt = (
-        "You are a supervisor managing two WORK agents:\n"
-        "- research_agent: research tasks via Tavily.\n"
-        "- calendar_agent: calendar CRUD via Google Calendar tools.\n\n"
-        "POLICY:\n"
-        "1) Pick exactly one WORK agent for the user's request.\n"
-        "2) After the WORK agent finishes, do NOT write any additional message. End immediately.\n"
-        "3) The WORK agent's reply MUST be a RESULT_JSON block. Do not format it yourself."
-    )
+    from langgraph_supervisor import create_supervisor
+
     return create_supervisor(
-        model=init_chat_model("openai:gpt-4o-mini"),
+        model=get_model(MODEL_NAME),
         agents=[research_agent, calendar_agent],
-        prompt=sup_prompt,
+        prompt=SUPERVISOR_PROMPT,
         add_handoff_back_messages=True,
-        output_mode="full_history",
+        output_mode="last_message",
     ).compile()
 
 
 
+# Function picks the work agent for clear-cut requests without an LLM call.
+# Cheap keyword matching sends obvious calendar or research requests straight to the
+# work agent; ambiguous input (both or neither keyword group) falls back to the supervisor.
+
+CAL_RE = re.compile(
+    r"\b(calendar|meetings?|events?|schedul\w*|invites?|reschedul\w*|cancel\w*|appointments?)\b", re.I
+)
+RES_RE = re.compile(r"\b(search|find|look up|news|who is|what is)\b", re.I)
+
+
+def route_intent(state: AgentState) -> str:
+    """Return "calendar", "research", or "llm" (let the supervisor decide)."""
+    text = message_text(state["messages"][-1])
+    is_calendar, is_research = bool(CAL_RE.search(text)), bool(RES_RE.search(text))
+    if is_calendar == is_research:
+        return "llm"
+    return "calendar" if is_calendar else "research"
+
+
+
+# Function decides whether the work output needs the formatter at all.
+# Without a RESULT_JSON label (e.g. the work agent asked a clarifying question)
+# there is nothing to render, so the agent's own message is passed through as the reply.
+# A labelled block that does not parse still goes to the formatter, so raw JSON never
+# reaches the user.
+
+def route_after_supervisor(state: AgentState) -> str:
+    """Return "format" if this turn produced a RESULT_JSON block, otherwise "done"."""
+    return "format" if has_result_json_label(state["messages"]) else "done"
+
+
+
 # Function creates the overall graph that connects all agents. 
-# The order is: START → supervisor → formatter_agent → END. 
-# This means the supervisor picks the right agent, and the formatter 
-# then turns the JSON output into readable text for the user.
+# The order is: START → (work agent | supervisor) → formatter_agent → END. 
+# Clear-cut requests go directly to the matching work agent; otherwise the supervisor
+# picks the right agent. The formatter then turns the JSON output into readable text for the user.
 
-def build_parent_graph(supervisor_runnable, formatter_agent):
+@st.cache_resource(show_spinner=False, hash_funcs={CompiledStateGraph: id})
+def build_parent_graph(supervisor_runnable, research_agent, calendar_agent):
     """
     Parent graph topology:
-        START → supervisor → formatter_agent → END
+        START → calendar_agent | research_agent | supervisor → formatter_agent → END
+                                                            ↘ passthrough → END (no RESULT_JSON)
     """
-    builder = StateGraph(MessagesState)
+    builder = StateGraph(AgentState, output_schema=ReplyState)
     builder.add_node("supervisor", supervisor_runnable)
-    builder.add_node("formatter_agent", formatter_agent)
-    builder.add_edge(START, "supervisor")
-    builder.add_edge("supervisor", "formatter_agent")
+    builder.add_node("calendar_agent", calendar_agent)
+    builder.add_node("research_agent", research_agent)
+    builder.add_node("formatter_agent", formatter_node)
+    builder.add_node("passthrough", passthrough_node)
+    builder.add_conditional_edges(
+        START,
+        route_intent,
+        {"calendar": "calendar_agent", "research": "research_agent", "llm": "supervisor"},
+    )
+    for node in ("supervisor", "calendar_agent", "research_agent"):
+        builder.add_conditional_edges(
+            node, route_after_supervisor, {"format": "formatter_agent", "done": "passthrough"}
+        )
     builder.add_edge("formatter_agent", END)
+    builder.add_edge("passthrough", END)
     return builder.compile()
 
 
 
-# Function runs the whole agent graph once with the given user text. 
-# It sends the user’s message into the system, waits for the result, 
-# and then returns only the final formatted answer (from the formatter agent).
+# Function assembles the complete application graph (tools, agents, supervisor, parent graph).
+# It is cached for the lifetime of the Streamlit process, so reruns (every chat input or
+# widget change) reuse the compiled graph instead of rebuilding it.
 
-def run_graph(app, user_text: str) -> str:
-    """Invoke the graph once and return the final assistant text (from formatter)."""
-    result = app.invoke({"messages": [HumanMessage(content=user_text)]})
-    msgs = result.get("messages", [])
-    if not msgs:
-        return ""
-    last = msgs[-1]
-    content = getattr(last, "content", "")
+@st.cache_resource(show_spinner="Building agents...")
+def get_app():
+    """Build and compile the parent graph once per process."""
+    calendar_tools = build_calendar_tools()
+    calendar_agent = create_calendar_agent(calendar_tools)
+    research_agent = create_research_agent()
+
+    supervisor_node = create_supervisor_runnable(research_agent, calendar_agent)
+    return build_parent_graph(supervisor_node, research_agent, calendar_agent)
+
+
+
+# Function renders a graph diagram as PNG. The image only depends on the graph topology,
+# so it is cached by name; the mermaid.ink request happens at most once per hour.
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def render_graph_png(_graph, name: str) -> bytes:
+    """Return the Mermaid PNG for `_graph`; `name` is the cache key."""
+    return _graph.get_graph().draw_mermaid_png()
+
+
+
+# Function starts one asyncio event loop in a background thread for the whole process.
+# Graph runs are scheduled on it, so the async HTTP clients (OpenAI, Tavily) keep their
+# connections between turns instead of being bound to a short-lived asyncio.run() loop.
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide event loop, running in a daemon thread."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True).start()
+    return loop
+
+
+
+# Function extracts the plain text of a message (or message chunk).
+# Content is almost always a plain string, so that case returns immediately; a list of typed
+# content parts is joined lazily. Text parts always carry a "text" key.
+
+def message_text(message) -> str:
+    """Return the text of `message`, joining text parts if content is a list."""
+    content = getattr(message, "content", "")
+    if isinstance(content, str):
+        return content
     if isinstance(content, list):
-        return "".join(p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text")
+        return "".join(p["text"] for p in content if p.__class__ is dict and p.get("type") == "text")
     return str(content)
 
 
+# Work agents whose own messages are user-facing replies (e.g. a clarifying question).
+# Tool-calling AI messages, including the supervisor's "Transferring back to supervisor"
+# handoff, are never a reply.
+WORK_AGENT_NAMES = ("calendar_agent", "research_agent")
+
+
+def last_reply_text(messages) -> str:
+    """Return the last work-agent answer in `messages`, else the last plain AI message text."""
+    fallback = ""
+    for msg in reversed(messages):
+        if not isinstance(msg, AIMessage) or msg.tool_calls:
+            continue
+        if msg.response_metadata.get("__is_handoff_back"):
+            continue
+        text = message_text(msg)
+        if not text:
+            continue
+        if msg.name in WORK_AGENT_NAMES:
+            return text
+        fallback = fallback or text
+    return fallback
+
+
+
+# Function runs the whole agent graph once with the given user text (for st.write_stream).
+# The graph is awaited on the shared event loop, so model and tool calls use their async
+# variants. Only per-node updates are read, never full state snapshots; the reply comes from
+# the `final` channel. Nothing is token-streamed: the formatter is plain Python and emits the
+# whole reply at once, so it is yielded as a single chunk.
+# The turn's parsed RESULT_JSON (if any) is stored in `turn["result"]` for the caller.
+
+def stream_reply(app, user_text: str, turn: dict | None = None):
+    """Yield the reply once the graph has produced it."""
+    turn = {} if turn is None else turn
+
+    async def run() -> str:
+        final = ""
+        async for data in app.astream(
+            {"messages": [HumanMessage(content=user_text)]}, stream_mode="updates"
+        ):
+            for update in data.values():
+                update = update or {}
+                if update.get("final"):
+                    final = update["final"]
+                elif update.get("messages"):
+                    turn["result"] = extract_last_result_json(update["messages"]) or turn.get("result")
+        return final
+
+    yield asyncio.run_coroutine_threadsafe(run(), get_event_loop()).result()
+
+
+
+# Functions for the per-session reply cache. Repeated questions (after normalizing case and
+# whitespace) are answered from st.session_state["cache"] without running the graph again.
+# Only successful research replies are cached: calendar answers go stale as soon as an event
+# is created, moved or deleted (in this session or elsewhere), so they always hit the API.
+
+REPLY_CACHE_SIZE = 128
+
+
+def reply_cache_key(user_text: str) -> str:
+    """Hash the normalized user text into a compact cache key."""
+    return hashlib.blake2b(user_text.strip().lower().encode(), digest_size=16).hexdigest()
+
+
+def is_cacheable(result) -> bool:
+    """Only successful research results may be served again from the cache."""
+    return bool(result) and bool(result.get("ok")) and result.get("agent") == "research"
+
+
+def cache_reply(cache: OrderedDict, key: str, reply: str) -> None:
+    """Insert `reply` into the LRU `cache`, evicting the oldest entry beyond REPLY_CACHE_SIZE."""
+    cache[key] = reply
+    cache.move_to_end(key)
+    if len(cache) > REPLY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
 
 # The main entry point of the app. It sets up the Streamlit interface (chat window), 
 # builds all agents and the supervisor, and then runs the agent graph for each user input. 
@@ -230,26 +684,19 @@ def main():
 
     # keep messages and other data in the session
     st.session_state.setdefault("messages", [])
-    st.session_state.setdefault("cache", {})
+    st.session_state.setdefault("cache", OrderedDict())
     st.session_state.setdefault("context", None)
 
-    # build all agents and the supervisor
-    calendar_tools = build_calendar_tools()
-    calendar_agent = create_calendar_agent(calendar_tools)
-    research_agent = create_research_agent()
-    formatter_agent = create_formatter_agent()
-
-    supervisor_node = create_supervisor_runnable(research_agent, calendar_agent)
-    app = build_parent_graph(supervisor_node, formatter_agent)
-
-     # create diagrams of the agent graph
-    png_parent = app.get_graph().draw_mermaid_png()
-    png_super  = supervisor_node.get_graph().draw_mermaid_png()
+    # build all agents and the supervisor (cached across reruns)
+    app = get_app()
+    start_token_refresher()
 
-    #uncomment to generate graph about architecture
-    # with st.expander("🗺️ Graphs"):
-    #     st.image(png_parent, caption="Parent Graph", use_column_width=True)
-    #     st.image(png_super,  caption="Supervisor Subgraph", use_column_width=True)
+    # diagrams of the agent graph, only rendered on request (they are fetched from mermaid.ink)
+    if st.sidebar.checkbox("Show graphs"):
+        png_parent = render_graph_png(app, "parent")
+        png_super  = render_graph_png(dict(app.get_subgraphs())["supervisor"], "supervisor")
+        st.sidebar.image(png_parent, caption="Parent Graph", use_column_width=True)
+        st.sidebar.image(png_super,  caption="Supervisor Subgraph", use_column_width=True)
 
 
     # chat interface
@@ -264,8 +711,17 @@ def main():
         st.session_state.messages.append({"role": "user", "content": user_text})
 
         with st.chat_message("assistant"):
-            reply = run_graph(app, user_text)
-            st.markdown(reply)
+            cache = st.session_state.cache
+            key = reply_cache_key(user_text)
+            reply = cache.get(key)
+            if reply is not None:
+                cache.move_to_end(key)
+                st.markdown(reply)
+            else:
+                turn = {}
+                reply = st.write_stream(stream_reply(app, user_text, turn))
+                if is_cacheable(turn.get("result")):
+                    cache_reply(cache, key, reply)
         st.session_state.messages.append({"role": "assistant", "content": reply})
 
 if __name__ == "__main__":